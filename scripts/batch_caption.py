@@ -5,38 +5,178 @@ Generates captions for all images in a folder using various AI models.
 """
 
 import argparse
+import hashlib
 import os
 import json
+import sqlite3
 import sys
-import subprocess
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Set, Tuple
 import logging
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 # Supported image extensions
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
 
-def find_image_files(source_folder: str) -> List[Path]:
-    """Find all image files in the source folder."""
+# Default location of the content-addressed caption cache
+DEFAULT_CACHE_PATH = Path.home() / '.fluxyoga' / 'caption_cache.sqlite'
+
+# Token budget used when --max_tokens is not given; Florence-2's
+# <MORE_DETAILED_CAPTION> output needs more room than the other models
+DEFAULT_MAX_TOKENS = 150
+MODEL_MAX_TOKENS = {'florence-2': 256}
+
+def _scan_directory(directory: str) -> Tuple[List[Path], Set[str], List[str]]:
+    """Scan one directory for images, existing captions and subdirectories."""
+    image_files = []
+    captioned = set()
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Symlinked directories are not descended into; one pointing back up
+            # the tree would otherwise make the recursive scan loop forever
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            base, suffix = os.path.splitext(entry.path)
+            suffix = suffix.lower()
+            # Windows and macOS filesystems treat foo.TXT as the caption file too
+            if suffix == '.txt':
+                captioned.add(base)
+            elif suffix in IMAGE_EXTENSIONS:
+                image_files.append(Path(entry.path))
+    
+    return image_files, captioned, subdirectories
+
+def find_image_files(source_folder: str, recursive: bool = False, io_workers: int = 1) -> Tuple[List[Path], Set[str]]:
+    """Find all image files in the source folder, plus the paths (minus suffix) of existing captions.
+
+    Both come from the directory scan itself so no per-image stat is needed to
+    tell whether a caption is already there. With recursive set, each level of
+    subdirectories is scanned in parallel across io_workers threads.
+    """
     source_path = Path(source_folder)
     if not source_path.exists():
         raise ValueError(f"Source folder does not exist: {source_folder}")
     
     image_files = []
-    for file_path in source_path.iterdir():
-        if file_path.is_file() and file_path.suffix.lower() in IMAGE_EXTENSIONS:
-            image_files.append(file_path)
+    captioned = set()
+    directories = [str(source_path)]
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        while directories:
+            next_directories = []
+            for found_images, found_captions, subdirectories in executor.map(_scan_directory, directories):
+                image_files.extend(found_images)
+                captioned.update(found_captions)
+                if recursive:
+                    next_directories.extend(subdirectories)
+            directories = next_directories
     
-    return sorted(image_files)
+    return sorted(image_files), captioned
 
-def caption_exists(image_path: Path) -> bool:
-    """Check if a caption file already exists for the image."""
-    caption_path = image_path.with_suffix('.txt')
-    return caption_path.exists()
+class JsonEmitter:
+    """Writes newline-delimited JSON messages to stdout, batching the writes.
+
+    Output is flushed once the buffer grows past max_buffer bytes or the oldest
+    pending message is max_delay seconds old. Throttled progress messages are
+    dropped if one was already emitted in the last progress_interval seconds.
+    """
+
+    def __init__(self, max_buffer: int = 4096, max_delay: float = 0.1, progress_interval: float = 0.1):
+        self.stream = sys.stdout.buffer
+        self.buffer = bytearray()
+        self.max_buffer = max_buffer
+        self.max_delay = max_delay
+        self.progress_interval = progress_interval
+        self.last_flush = time.monotonic()
+        self.last_progress = 0.0
+
+    def emit(self, message: Dict[str, Any], throttle: bool = False) -> None:
+        now = time.monotonic()
+        if throttle:
+            if now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+
+        if HAS_ORJSON:
+            self.buffer += orjson.dumps(message)
+        else:
+            self.buffer += json.dumps(message, ensure_ascii=False).encode('utf-8')
+        self.buffer += b'\n'
+
+        if len(self.buffer) > self.max_buffer or now - self.last_flush > self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.stream.write(self.buffer)
+            self.stream.flush()
+            self.buffer.clear()
+        self.last_flush = time.monotonic()
+
+def hash_image(image_path: Path) -> str | None:
+    """Hash the image bytes so identical content is recognised under any filename."""
+    hasher = xxhash.xxh3_64() if HAS_XXHASH else hashlib.blake2b(digest_size=16)
+    try:
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+    except OSError as e:
+        logger.warning(f"Could not hash {image_path.name}: {e}")
+        return None
+    return hasher.hexdigest()
+
+class CaptionCache:
+    """Captions already generated for an image's content, keyed by image hash and caption settings."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS captions ('
+            'image_hash TEXT NOT NULL, settings TEXT NOT NULL, caption TEXT NOT NULL, '
+            'PRIMARY KEY (image_hash, settings))'
+        )
+
+    def get(self, image_hash: str, settings: str) -> str | None:
+        row = self.connection.execute(
+            'SELECT caption FROM captions WHERE image_hash = ? AND settings = ?',
+            (image_hash, settings)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, image_hash: str, settings: str, caption: str) -> None:
+        self.connection.execute(
+            'INSERT OR REPLACE INTO captions (image_hash, settings, caption) VALUES (?, ?, ?)',
+            (image_hash, settings, caption)
+        )
+
+    def flush(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
 
 def save_caption(image_path: Path, caption: str, template: str | None = None) -> None:
     """Save caption to a text file alongside the image."""
@@ -49,78 +189,145 @@ def save_caption(image_path: Path, caption: str, template: str | None = None) ->
     with open(caption_path, 'w', encoding='utf-8') as f:
         f.write(final_caption)
 
-def generate_caption_for_image(image_path: Path, model: str, style: str = 'detailed', max_tokens: int = 150) -> str:
-    """Generate caption for a single image using the specified model."""
-    script_dir = Path(__file__).parent
-    models_dir = script_dir.parent / 'models' / 'llm'
-    image_str = str(image_path)
-    
-    try:
-        if model in ['blip', 'blip2']:
-            script_path = script_dir / 'generate_blip_caption.py'
-            model_type = 'large' if model == 'blip2' else 'base'
-            
-            cmd = [
-                sys.executable, str(script_path),
-                '--image_path', image_str,
-                '--model_type', model_type,
-                '--max_tokens', str(max_tokens),
-                '--style', style
-            ]
-            
-        elif model == 'gpt-4-vision':
-            script_path = script_dir / 'generate_gpt4v_caption.py'
-            cmd = [
-                sys.executable, str(script_path),
-                '--image_path', image_str,
-                '--style', style,
-                '--max_tokens', str(max_tokens)
-            ]
-            
-        elif model == 'vit-gpt2':
-            script_path = script_dir / 'generate_ofa_caption.py'
-            cmd = [
-                sys.executable, str(script_path),
-                '--image_path', image_str,
-                '--max_length', str(max_tokens),
-                '--style', style
-            ]
-            
-        elif model == 'florence-2':
-            script_path = script_dir / 'generate_florence2_caption.py'
-            cmd = [
-                sys.executable, str(script_path),
-                '--image_path', image_str,
-                '--model_id', 'microsoft/Florence-2-base',
-                '--prompt', '<MORE_DETAILED_CAPTION>'
-            ]
-            
-        else:
-            raise ValueError(f"Unsupported model: {model}")
-        
-        # Run the caption generation script
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        
-        if result.returncode == 0:
-            # For Florence-2, parse JSON response
-            if model == 'florence-2':
-                try:
-                    response = json.loads(result.stdout.strip())
-                    return response.get('caption', 'No caption generated')
-                except json.JSONDecodeError:
-                    return result.stdout.strip()
-            else:
-                return result.stdout.strip()
-        else:
-            error_msg = result.stderr.strip() or "Unknown error"
-            logger.error(f"Caption generation failed for {image_path}: {error_msg}")
-            return f"Error: {error_msg}"
-            
-    except subprocess.TimeoutExpired:
-        return "Error: Caption generation timed out"
-    except Exception as e:
-        logger.error(f"Error generating caption for {image_path}: {e}")
-        return f"Error: {str(e)}"
+# A captioner maps a batch of image paths or decoded images to their captions
+Captioner = Callable[[List[Any]], List[str]]
+
+def _warm_up(caption: Captioner, batch_size: int) -> None:
+    """Run one throwaway batch so torch.compile finishes before real images arrive."""
+    import torch
+    from PIL import Image
+
+    # Models are only compiled on CUDA
+    if not torch.cuda.is_available():
+        return
+
+    logger.info("Compiling caption model (first batch is slower)")
+    caption([Image.new('RGB', (224, 224))] * batch_size)
+
+def _load_blip(args: argparse.Namespace) -> Captioner:
+    """Load BLIP once and return a batch captioner bound to it."""
+    import generate_blip_caption
+
+    model_type = 'large' if args.model == 'blip2' else 'base'
+    processor, caption_model = generate_blip_caption.load_model(
+        model_type,
+        compile_model=not args.no_compile,
+        load_in_8bit=args.load_in_8bit
+    )
+
+    def caption(images: List[Any]) -> List[str]:
+        return generate_blip_caption.generate_captions_batch(
+            images,
+            processor,
+            caption_model,
+            batch_size=args.batch_size,
+            max_length=args.max_tokens,
+            style=args.style
+        )
+
+    if not args.no_compile:
+        _warm_up(caption, args.batch_size)
+
+    return caption
+
+def _load_vit_gpt2(args: argparse.Namespace) -> Captioner:
+    """Load VIT-GPT2 once and return a batch captioner bound to it."""
+    import generate_ofa_caption_fixed
+
+    tokenizer, caption_model = generate_ofa_caption_fixed.load_model(
+        compile_model=not args.no_compile,
+        load_in_8bit=args.load_in_8bit
+    )
+
+    def caption(images: List[Any]) -> List[str]:
+        return generate_ofa_caption_fixed.generate_captions_batch(
+            images,
+            tokenizer,
+            caption_model,
+            batch_size=args.batch_size,
+            max_length=args.max_tokens,
+            style=args.style
+        )
+
+    if not args.no_compile:
+        _warm_up(caption, args.batch_size)
+
+    return caption
+
+def _load_florence2(args: argparse.Namespace) -> Captioner:
+    """Load Florence-2 once and return a batch captioner bound to it."""
+    import generate_florence2_caption
+
+    model_source = 'microsoft/Florence-2-base'
+    processor, caption_model, device = generate_florence2_caption.get_florence_model(model_source, not args.no_compile)
+
+    def caption(images: List[Any]) -> List[str]:
+        return generate_florence2_caption.generate_captions_batch(
+            images,
+            processor,
+            caption_model,
+            device,
+            prompt='<MORE_DETAILED_CAPTION>',
+            batch_size=args.batch_size,
+            max_new_tokens=args.max_tokens,
+            num_beams=3 if args.quality else 1
+        )
+
+    if not args.no_compile:
+        _warm_up(caption, args.batch_size)
+
+    return caption
+
+def _load_gpt4v(args: argparse.Namespace) -> Captioner:
+    """Return a captioner that sends each batch to GPT-4V as concurrent HTTP requests."""
+    import requests
+    import generate_gpt4v_caption
+
+    # One session keeps TLS connections alive across requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount('https://', adapter)
+    pool = ThreadPoolExecutor(max_workers=args.concurrency)
+
+    def caption_one(image_path: Path) -> str:
+        try:
+            return generate_gpt4v_caption.generate_caption(
+                str(image_path),
+                max_tokens=args.max_tokens,
+                style=args.style,
+                session=session
+            )
+        except Exception as e:
+            logger.error(f"Error generating caption for {image_path}: {e}")
+            return f"Error: {str(e)}"
+
+    def caption(image_paths: List[Path]) -> List[str]:
+        return list(pool.map(caption_one, image_paths))
+
+    return caption
+
+# Each loader is called once per batch run and returns a captioner that reuses the loaded model.
+# Local models accept decoded PIL images so decoding can run ahead of inference.
+MODEL_LOADERS: Dict[str, Callable[[argparse.Namespace], Captioner]] = {
+    'blip': _load_blip,
+    'blip2': _load_blip,
+    'vit-gpt2': _load_vit_gpt2,
+    'florence-2': _load_florence2,
+    'gpt-4-vision': _load_gpt4v,
+}
+
+# Models whose captioners take decoded images rather than file paths
+DECODE_AHEAD_MODELS = {'blip', 'blip2', 'vit-gpt2', 'florence-2'}
+
+# Threads decoding the next batch while the current one runs on the model
+DECODE_WORKERS = 4
+
+def decode_image(image_path: Path):
+    """Decode an image to RGB so the model scripts can skip the file read."""
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        return image.convert('RGB')
 
 def main():
     parser = argparse.ArgumentParser(description='Generate captions for images in batch')
@@ -131,19 +338,35 @@ def main():
                        help='Caption style (for GPT-4V)')
     parser.add_argument('--template', help='Caption template with {caption} placeholder')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite existing captions')
-    parser.add_argument('--max_tokens', type=int, default=150, help='Maximum tokens for caption generation')
+    parser.add_argument('--max_tokens', type=int,
+                       help='Maximum tokens for caption generation (default: 256 for Florence-2, 150 otherwise)')
+    parser.add_argument('--batch_size', type=int, default=4, help='Number of images captioned per model call')
+    parser.add_argument('--recursive', action='store_true', help='Also caption images in subfolders')
+    parser.add_argument('--io_workers', type=int, default=4, help='Threads used for folder scanning and caption writes')
+    parser.add_argument('--no-compile', dest='no_compile', action='store_true',
+                       help='Run local models eagerly instead of with torch.compile (useful for debugging)')
+    parser.add_argument('--load_in_8bit', action='store_true',
+                       help='Load BLIP/VIT-GPT2 language decoders with int8 weights (requires bitsandbytes)')
+    parser.add_argument('--cache_path', default=str(DEFAULT_CACHE_PATH),
+                       help='SQLite file reusing captions for images with identical content')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read or write the caption cache')
+    parser.add_argument('--concurrency', type=int, default=8, help='Parallel GPT-4V requests in flight')
+    parser.add_argument('--quality', action='store_true', help='Use beam search with Florence-2 (slower, more careful captions)')
     
     args = parser.parse_args()
+    if args.max_tokens is None:
+        args.max_tokens = MODEL_MAX_TOKENS.get(args.model, DEFAULT_MAX_TOKENS)
+    emitter = JsonEmitter()
     
     try:
         # Find all image files
-        image_files = find_image_files(args.source_folder)
+        image_files, captioned = find_image_files(args.source_folder, args.recursive, args.io_workers)
         
         if not image_files:
-            print(json.dumps({
+            emitter.emit({
                 "type": "error",
                 "message": f"No image files found in {args.source_folder}"
-            }))
+            })
             return
         
         total_files = len(image_files)
@@ -151,78 +374,179 @@ def main():
         skipped_files = []
         failed_files = []
         
-        print(json.dumps({
+        emitter.emit({
             "type": "progress",
             "message": f"Found {total_files} images to process"
-        }))
+        })
         
+        # Skip images that already have captions
+        pending = []
         for i, image_path in enumerate(image_files):
-            try:
-                # Check if caption already exists
-                if not args.overwrite and caption_exists(image_path):
-                    skipped_files.append(str(image_path.name))
-                    print(json.dumps({
-                        "type": "progress",
-                        "message": f"Skipped {image_path.name} (caption exists)"
-                    }))
-                    continue
-                
-                print(json.dumps({
+            if not args.overwrite and str(image_path.with_suffix('')) in captioned:
+                skipped_files.append(str(image_path.name))
+                emitter.emit({
                     "type": "progress",
-                    "message": f"Processing {i+1}/{total_files}: {image_path.name}",
-                    "current": i+1,
-                    "total": total_files,
-                    "filename": str(image_path.name)
-                }))
-                
-                # Generate caption
-                caption = generate_caption_for_image(
-                    image_path, 
-                    args.model, 
-                    args.style, 
-                    args.max_tokens
-                )
-                
-                if caption and not caption.startswith("Error"):
-                    # Save caption
-                    save_caption(image_path, caption, args.template)
-                    processed_files.append(str(image_path.name))
-                    
-                    print(json.dumps({
-                        "type": "file_processed",
-                        "filename": str(image_path.name),
-                        "caption": caption[:100] + "..." if len(caption) > 100 else caption
-                    }))
+                    "message": f"Skipped {image_path.name} (caption exists)"
+                }, throttle=True)
+            else:
+                pending.append((i, image_path))
+        
+        # Reuse captions for image content seen before, and caption identical
+        # images within this run only once
+        cache = None if args.no_cache else CaptionCache(Path(args.cache_path))
+        cache_settings = f"{args.model}|{args.style}|{args.max_tokens}|{'quality' if args.quality else 'fast'}"
+        cached = []
+        image_hashes = {}
+        duplicates = defaultdict(list)
+        if cache is not None and pending:
+            with ThreadPoolExecutor(max_workers=args.io_workers) as hasher:
+                hashes = list(hasher.map(hash_image, [image_path for _, image_path in pending]))
+            
+            uncached = []
+            for (i, image_path), image_hash in zip(pending, hashes):
+                if image_hash is None:
+                    uncached.append((i, image_path))
+                    continue
+                # --overwrite regenerates captions rather than trusting the cache
+                caption = None if args.overwrite else cache.get(image_hash, cache_settings)
+                if caption is not None:
+                    cached.append((image_path, caption))
+                elif image_hash in duplicates:
+                    duplicates[image_hash].append(image_path)
                 else:
-                    failed_files.append(str(image_path.name))
-                    logger.error(f"Failed to generate caption for {image_path.name}")
+                    image_hashes[image_path] = image_hash
+                    duplicates[image_hash] = []
+                    uncached.append((i, image_path))
+            pending = uncached
+        
+        # Load the model once and reuse it for every batch
+        if pending:
+            generate_captions = MODEL_LOADERS[args.model](args)
+        
+        def report_saved(future, image_path: Path, caption: str) -> None:
+            try:
+                future.result()
+                processed_files.append(str(image_path.name))
                 
+                emitter.emit({
+                    "type": "file_processed",
+                    "filename": str(image_path.name),
+                    "caption": caption[:100] + "..." if len(caption) > 100 else caption
+                })
             except Exception as e:
                 failed_files.append(str(image_path.name))
                 logger.error(f"Error processing {image_path.name}: {e}")
         
+        # Caption writes run on a thread pool so inference never waits on disk;
+        # the in-flight queue is bounded so a slow disk still applies backpressure
+        max_in_flight = args.io_workers * 4
+        in_flight = deque()
+        # GPT-4V batches are fanned out as concurrent requests, so size them to fill the pool
+        batch_size = max(args.batch_size, args.concurrency) if args.model == 'gpt-4-vision' else args.batch_size
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        decode_ahead = args.model in DECODE_AHEAD_MODELS
+        with ThreadPoolExecutor(max_workers=args.io_workers) as writer, \
+                ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decoder:
+            for image_path, caption in cached:
+                future = writer.submit(save_caption, image_path, caption, args.template)
+                in_flight.append((future, image_path, caption))
+            
+            def submit_decode(batch):
+                return [decoder.submit(decode_image, image_path) for _, image_path in batch]
+            
+            next_decoded = submit_decode(batches[0]) if batches and decode_ahead else None
+            for batch_index, batch in enumerate(batches):
+                # Start decoding the following batch while this one is captioned
+                decoded = next_decoded
+                if decode_ahead and batch_index + 1 < len(batches):
+                    next_decoded = submit_decode(batches[batch_index + 1])
+                
+                for i, image_path in batch:
+                    emitter.emit({
+                        "type": "progress",
+                        "message": f"Processing {i+1}/{total_files}: {image_path.name}",
+                        "current": i+1,
+                        "total": total_files,
+                        "filename": str(image_path.name)
+                    }, throttle=True)
+                
+                # Generate captions for the whole batch
+                try:
+                    # Images that failed to decode are reported on their own
+                    # instead of failing the rest of the batch
+                    captions = [None] * len(batch)
+                    inputs = []
+                    for index, (_, image_path) in enumerate(batch):
+                        if decoded is None:
+                            inputs.append((index, image_path))
+                            continue
+                        try:
+                            inputs.append((index, decoded[index].result()))
+                        except Exception as e:
+                            captions[index] = f"Error: {str(e)}"
+                    
+                    # Show this batch's progress before the model call blocks
+                    emitter.flush()
+                    if inputs:
+                        for (index, _), caption in zip(inputs, generate_captions([image for _, image in inputs])):
+                            captions[index] = caption
+                except Exception as e:
+                    logger.error(f"Error generating captions for batch: {e}")
+                    captions = [f"Error: {str(e)}"] * len(batch)
+                
+                for (i, image_path), caption in zip(batch, captions):
+                    image_hash = image_hashes.get(image_path)
+                    copies = duplicates.get(image_hash, []) if image_hash else []
+                    if caption and not caption.startswith("Error"):
+                        if image_hash:
+                            cache.put(image_hash, cache_settings, caption)
+                        
+                        # Save caption in the background, including identical images
+                        for target_path in [image_path] + copies:
+                            future = writer.submit(save_caption, target_path, caption, args.template)
+                            in_flight.append((future, target_path, caption))
+                    else:
+                        for target_path in [image_path] + copies:
+                            failed_files.append(str(target_path.name))
+                            logger.error(f"Failed to generate caption for {target_path.name}")
+                
+                if cache is not None:
+                    cache.flush()
+                
+                # Report finished writes in order, blocking only when the queue is full
+                while in_flight and (in_flight[0][0].done() or len(in_flight) > max_in_flight):
+                    report_saved(*in_flight.popleft())
+            
+            while in_flight:
+                report_saved(*in_flight.popleft())
+        
+        if cache is not None:
+            cache.close()
+        
         # Final summary
-        print(json.dumps({
+        emitter.emit({
             "type": "summary",
             "total_files": total_files,
             "processed": len(processed_files),
             "skipped": len(skipped_files),
             "failed": len(failed_files),
             "processed_files": processed_files
-        }))
+        })
         
-        print(json.dumps({
+        emitter.emit({
             "type": "progress",
             "message": f"Batch caption generation completed! Processed: {len(processed_files)}, Skipped: {len(skipped_files)}, Failed: {len(failed_files)}"
-        }))
+        })
         
     except Exception as e:
-        print(json.dumps({
+        emitter.emit({
             "type": "error",
             "message": f"Batch caption generation failed: {str(e)}"
-        }))
+        })
         logger.error(f"Batch caption generation failed: {e}")
         sys.exit(1)
+    finally:
+        emitter.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Persistent caption worker
+Imports the caption models once and answers one JSON request per stdin line:
+{"model": "blip", "image_path": "...", "style": "detailed", "max_tokens": 150}
+Each request gets one JSON line on stdout with either "caption" or "error".
+"""
+
+import json
+import sys
+
+import generate_blip_caption
+import generate_ofa_caption
+
+# Model name -> (loader, caption function, default max length)
+MODELS = {
+    'blip': (lambda: generate_blip_caption.load_model('base'), generate_blip_caption.generate_caption, 150),
+    'blip2': (lambda: generate_blip_caption.load_model('large'), generate_blip_caption.generate_caption, 150),
+    'vit-gpt2': (generate_ofa_caption.load_model, generate_ofa_caption.generate_caption, 50),
+}
+
+# Only the most recently used model stays loaded
+loaded = {}
+
+def get_model(model_name):
+    """Load a model, releasing whichever one was loaded before"""
+    if model_name not in loaded:
+        loaded.clear()
+        loaded[model_name] = MODELS[model_name][0]()
+    return loaded[model_name]
+
+def run(request):
+    """Caption the image named by a single request"""
+    model_name = request['model']
+    if model_name not in MODELS:
+        raise ValueError(f"Unknown model: {model_name}")
+
+    _, generate_caption, max_length = MODELS[model_name]
+    processor, model = get_model(model_name)
+    return generate_caption(
+        request['image_path'],
+        processor,
+        model,
+        max_length=request.get('max_tokens', max_length),
+        style=request.get('style', 'detailed')
+    )
+
+def main():
+    # Keep library output off the response stream
+    responses = sys.stdout
+    sys.stdout = sys.stderr
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            response = {'caption': run(json.loads(line))}
+        except SystemExit as e:
+            # The caption scripts exit on load/preprocess failures
+            response = {'error': f"Caption script exited with status {e.code}"}
+        except Exception as e:
+            response = {'error': str(e)}
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,20 @@
 #!/usr/bin/env python3
-def main():
-    print("FluxY        print("✅ All required packages are installed!")
-        print("FluxYoga should work correctly.")
-    else: Python Environment Check")
-    print("=" * 35)
+"""
 Python Environment Check Script
 Verifies that all required packages are installed for FluxYoga.
 """
 
+import argparse
+import ctypes.util
 import sys
-import subprocess
 import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 
 def check_package(package_name, import_name=None):
     """Check if a package is installed and importable."""
     if import_name is None:
         import_name = package_name
-    
+
     try:
         spec = importlib.util.find_spec(import_name)
         if spec is not None:
@@ -26,10 +24,20 @@ def check_package(package_name, import_name=None):
     except Exception as e:
         return False, f"✗ Error: {e}"
 
+def has_cuda_driver():
+    """Check for the CUDA driver library without importing torch."""
+    library = 'nvcuda' if sys.platform == 'win32' else 'cuda'
+    return ctypes.util.find_library(library) is not None
+
 def main():
+    parser = argparse.ArgumentParser(description="Check the Python environment for FluxYoga")
+    parser.add_argument("--no-vision", dest="no_vision", action="store_true",
+                        help="Skip checking torchvision")
+    args = parser.parse_args()
+
     print("FluxyYoga Python Environment Check")
     print("=" * 40)
-    
+
     # Required packages
     packages = [
         ('torch', 'torch'),
@@ -41,29 +49,37 @@ def main():
         ('numpy', 'numpy'),
         ('safetensors', 'safetensors'),
     ]
-    
+    if args.no_vision:
+        packages = [package for package in packages if package[0] != 'torchvision']
+
+    # find_spec walks sys.path on disk, so look packages up concurrently
+    with ThreadPoolExecutor(max_workers=len(packages)) as executor:
+        results = list(executor.map(lambda package: check_package(*package), packages))
+
     all_installed = True
-    
-    for package_name, import_name in packages:
-        installed, status = check_package(package_name, import_name)
+
+    for (package_name, _), (installed, status) in zip(packages, results):
         print(f"{package_name:15} {status}")
         if not installed:
             all_installed = False
-    
+
     print("\n" + "=" * 40)
-    
+
     if all_installed:
         print("✓ All required packages are installed!")
         print("FluxYoga should work correctly.")
     else:
         print("✗ Some packages are missing.")
         print("Run: pip install -r requirements.txt")
-    
+
     # Check Python version
     print(f"\nPython version: {sys.version}")
     if sys.version_info < (3, 8):
         print("⚠ Warning: Python 3.8+ is recommended")
-    
+
+    if not has_cuda_driver():
+        print("⚠ Warning: CUDA driver not found, models will run on CPU")
+
     return 0 if all_installed else 1
 
 if __name__ == "__main__":
@@ -1,27 +1,99 @@
 import argparse
+import functools
+import importlib.util
+import json
 import sys
 import torch
 from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers import BitsAndBytesConfig, BlipProcessor, BlipForConditionalGeneration
 
-def load_model(model_type="base"):
+HAS_BITSANDBYTES = importlib.util.find_spec("bitsandbytes") is not None
+
+# Strips punctuation before captions are split into tags
+TAG_PUNCTUATION = str.maketrans("", "", ".,")
+
+# Input shapes are fixed per batch size, so let cuDNN pick the fastest kernels
+torch.backends.cudnn.benchmark = True
+
+def load_model(model_type="base", compile_model=False, load_in_8bit=False):
     if model_type == "base":
         model_name = "Salesforce/blip-image-captioning-base"
     else:
         model_name = "Salesforce/blip-image-captioning-large"
     
     processor = BlipProcessor.from_pretrained(model_name)
+    
+    if load_in_8bit and not (torch.cuda.is_available() and HAS_BITSANDBYTES):
+        print("Warning: int8 loading needs CUDA and bitsandbytes, using full precision", file=sys.stderr)
+        load_in_8bit = False
+    
+    if load_in_8bit:
+        # Quantize only the text decoder; the vision encoder stays in fp16
+        model = BlipForConditionalGeneration.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=["vision_model"]),
+            device_map="auto"
+        )
+        model.eval()
+        model.requires_grad_(False)
+        return processor, model
+    
     model = BlipForConditionalGeneration.from_pretrained(model_name)
+    model.eval()
+    model.requires_grad_(False)
     
     if torch.cuda.is_available():
         model = model.to("cuda")
+        
+        # generate() never calls model.forward; it runs the vision encoder and
+        # then text_decoder.generate, which calls the decoder's forward per step
+        if compile_model:
+            model.vision_model.forward = torch.compile(model.vision_model.forward, mode="reduce-overhead")
+            # The sequence grows every step, so compile the decoder for dynamic shapes
+            model.text_decoder.forward = torch.compile(model.text_decoder.forward, dynamic=True)
     
     return processor, model
 
-def generate_caption(
-    image_path,
+def load_image(image):
+    """Open an image path as RGB, passing through images that were already decoded"""
+    if isinstance(image, Image.Image):
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    return Image.open(image).convert('RGB')
+
+def get_conditional_text(style):
+    """Return the conditioning prompt BLIP uses for a caption style"""
+    if style == "detailed":
+        return "a detailed description of"
+    elif style == "simple":
+        return "a simple description of"
+    elif style == "tags":
+        return "list the key elements in"
+    elif style == "artistic":
+        return "describe the artistic elements in"
+    else:
+        return "describe"
+
+@functools.lru_cache(maxsize=8)
+def tokenize_prompt(processor, text):
+    """Tokenize a conditioning prompt once per processor instead of once per image"""
+    encoding = processor.tokenizer(text, return_tensors="pt")
+    return encoding.input_ids, encoding.attention_mask
+
+def postprocess_caption(caption, style):
+    """Post-process a decoded caption based on style"""
+    if style == "tags":
+        # Convert prose to comma-separated tags
+        words = caption.lower().translate(TAG_PUNCTUATION).split()
+        caption = ", ".join(dict.fromkeys(words))
+    
+    return caption
+
+def generate_captions_batch(
+    image_paths,
     processor,
     model,
+    batch_size=8,
     max_length=150,
     num_beams=5,
     min_length=5,
@@ -29,64 +101,104 @@ def generate_caption(
     repetition_penalty=1.5,
     style="detailed"
 ):
-    # Load and preprocess the image
-    image = Image.open(image_path)
-    
-    # Convert RGBA to RGB if necessary
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
+    """Generate captions for several image paths or decoded images, running one model.generate per batch"""
+    conditional_text = get_conditional_text(style)
+    captions = []
     
-    # Prepare conditional text based on style
-    if style == "detailed":
-        conditional_text = "a detailed description of"
-    elif style == "simple":
-        conditional_text = "a simple description of"
-    elif style == "tags":
-        conditional_text = "list the key elements in"
-    elif style == "artistic":
-        conditional_text = "describe the artistic elements in"
-    else:
-        conditional_text = "describe"
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        
+        # Load and preprocess the images
+        images = [load_image(image) for image in batch_paths]
+        input_ids, attention_mask = tokenize_prompt(processor, conditional_text)
+        inputs = {
+            "pixel_values": processor.image_processor(images, return_tensors="pt").pixel_values.to(model.dtype),
+            "input_ids": input_ids.repeat(len(images), 1),
+            "attention_mask": attention_mask.repeat(len(images), 1),
+        }
+        
+        if torch.cuda.is_available():
+            inputs = {k: v.to("cuda") for k, v in inputs.items()}
+
+        # Generate captions
+        with torch.inference_mode():
+            out = model.generate(
+                **inputs,
+                max_length=max_length,
+                num_beams=num_beams,
+                min_length=min_length,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+            )
 
-    # Preprocess the image
-    inputs = processor(image, conditional_text, return_tensors="pt")
+        # Decode and post-process the captions
+        for caption in processor.batch_decode(out, skip_special_tokens=True):
+            captions.append(postprocess_caption(caption, style))
     
-    if torch.cuda.is_available():
-        inputs = {k: v.to("cuda") for k, v in inputs.items()}
+    return captions
 
-    # Generate caption
-    out = model.generate(
-        **inputs,
+def generate_caption(
+    image_path,
+    processor,
+    model,
+    max_length=150,
+    num_beams=5,
+    min_length=5,
+    top_p=0.9,
+    repetition_penalty=1.5,
+    style="detailed"
+):
+    return generate_captions_batch(
+        [image_path],
+        processor,
+        model,
+        batch_size=1,
         max_length=max_length,
         num_beams=num_beams,
         min_length=min_length,
         top_p=top_p,
         repetition_penalty=repetition_penalty,
-    )
+        style=style
+    )[0]
 
-    # Decode and return the caption
-    caption = processor.decode(out[0], skip_special_tokens=True)
-    
-    # Post-process based on style
-    if style == "tags":
-        # Convert prose to comma-separated tags
-        words = caption.lower().replace(".", "").replace(",", "").split()
-        unique_words = list(set(words))
-        caption = ", ".join(unique_words)
-    
-    return caption
+def serve(processor, model, max_length=150, style="detailed"):
+    """Caption images named by JSON lines on stdin, writing one JSON line per request"""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            caption = generate_caption(
+                request["image_path"],
+                processor,
+                model,
+                max_length=request.get("max_tokens", max_length),
+                style=request.get("style", style)
+            )
+            response = {"caption": caption}
+        except Exception as e:
+            response = {"error": str(e)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
 
 def main():
     parser = argparse.ArgumentParser(description="Generate image captions using BLIP")
-    parser.add_argument("--image_path", required=True, help="Path to the image file")
+    parser.add_argument("--image_path", help="Path to the image file")
     parser.add_argument("--model_type", default="base", choices=["base", "large"], help="BLIP model type")
     parser.add_argument("--max_tokens", type=int, default=150, help="Maximum length of caption")
     parser.add_argument("--style", default="detailed", choices=["detailed", "simple", "tags", "artistic"])
+    parser.add_argument("--serve", action="store_true", help="Keep the model loaded and caption image paths read from stdin")
     
     args = parser.parse_args()
+    if not args.serve and not args.image_path:
+        parser.error("--image_path is required unless --serve is set")
     
     try:
         processor, model = load_model(args.model_type)
+        if args.serve:
+            serve(processor, model, max_length=args.max_tokens, style=args.style)
+            return
+        
         caption = generate_caption(
             args.image_path,
             processor,
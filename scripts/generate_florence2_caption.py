@@ -4,6 +4,7 @@ Generates detailed captions using Florence-2-base-PromptGen-v2.0 model
 """
 
 import argparse
+import functools
 import json
 import sys
 from pathlib import Path
@@ -16,128 +17,255 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_florence_model(model_source):
+# Florence-2 resizes every image to the same input size, so let cuDNN pick the fastest kernels
+torch.backends.cudnn.benchmark = True
+
+def get_model_dtype(device):
+    """Pick the half-precision dtype the GPU supports, or float32 on CPU"""
+    if device != "cuda":
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+def load_florence_model(model_source, compile_model=False):
     """Load Florence-2 model and processor from local path or Hugging Face Hub"""
     try:
         logger.info(f"Loading Florence-2 model from {model_source}")
         
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        dtype = get_model_dtype(device)
+        
         # Load processor and model
         processor = AutoProcessor.from_pretrained(model_source, trust_remote_code=True)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_source, 
-            trust_remote_code=True,
-            torch_dtype=torch.float32,  # Use float32 to avoid type mismatch
-            attn_implementation="eager"  # Use eager attention to avoid SDPA issues
-        )
+        
+        # Prefer fused attention kernels; Florence-2's remote code rejects some of them
+        attn_implementations = ["sdpa", "flash_attention_2", "eager"] if device == "cuda" else ["sdpa", "eager"]
+        for attn_implementation in attn_implementations:
+            try:
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_source, 
+                    trust_remote_code=True,
+                    torch_dtype=dtype,
+                    attn_implementation=attn_implementation
+                )
+                break
+            # Florence-2's remote code reads self.language_model from its
+            # _supports_sdpa/_supports_flash_attn_2 properties before that
+            # attribute exists, so an unsupported request can surface as an
+            # AttributeError rather than ValueError/ImportError
+            except Exception as attn_error:
+                if attn_implementation == attn_implementations[-1]:
+                    raise
+                logger.warning(f"{attn_implementation} attention unavailable ({attn_error}), trying next")
         
         # Move to GPU if available
-        device = "cuda" if torch.cuda.is_available() else "cpu"
         model = model.to(device)
+        model.eval()
+        model.requires_grad_(False)
+        
+        # generate() never calls model.forward; it encodes the image and then
+        # runs language_model.generate, which calls the language model's forward
+        # per step. The sequence grows every step, so compile for dynamic shapes
+        if compile_model and device == "cuda":
+            model.language_model.forward = torch.compile(model.language_model.forward, dynamic=True)
         
-        logger.info(f"Model loaded successfully on {device}")
+        logger.info(f"Model loaded successfully on {device} ({dtype}, {attn_implementation} attention)")
         return processor, model, device
         
     except Exception as e:
         logger.error(f"Error loading model: {e}")
         return None, None, None
 
-def generate_caption(image_path, processor, model, device, prompt="<MORE_DETAILED_CAPTION>"):
-    """Generate caption for a single image using Florence-2"""
+def load_image(image):
+    """Open an image path as RGB, passing through images that were already decoded"""
+    if isinstance(image, Image.Image):
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    return Image.open(image).convert('RGB')
+
+@functools.lru_cache(maxsize=8)
+def tokenize_prompt(processor, prompt):
+    """Tokenize a task prompt once per processor instead of once per image"""
+    # Florence-2's processor expands task tokens such as <MORE_DETAILED_CAPTION> into full instructions
+    construct_prompts = getattr(processor, "_construct_prompts", None)
+    text = construct_prompts([prompt])[0] if construct_prompts else prompt
+    return processor.tokenizer(text, return_tensors="pt").input_ids
+
+def parse_caption(processor, generated_text, prompt, image_size):
+    """Extract the caption from Florence-2's raw generated text"""
     try:
-        # Load and process image
-        image = Image.open(image_path).convert('RGB')
-        
-        # Prepare inputs for Florence-2
-        inputs = processor(text=prompt, images=image, return_tensors="pt")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        
-        # Generate caption
-        with torch.no_grad():
-            generated_ids = model.generate(
-                input_ids=inputs["input_ids"],
-                pixel_values=inputs["pixel_values"],
-                max_new_tokens=1024,
-                early_stopping=False,
-                do_sample=False,
-                num_beams=3,
-                pad_token_id=processor.tokenizer.pad_token_id,
-                use_cache=False  # Disable cache during generation
-            )
-        
-        # Decode the generated caption
-        generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+        parsed_answer = processor.post_process_generation(
+            generated_text, 
+            task=prompt, 
+            image_size=image_size
+        )
         
-        # Parse the response using processor's post-processing
+        # Extract caption from parsed answer
+        if prompt in parsed_answer:
+            return parsed_answer[prompt]
+        else:
+            # Fallback: try to extract from raw text
+            return generated_text.split(prompt)[-1].strip()
+    except Exception as parse_error:
+        logger.warning(f"Post-processing failed: {parse_error}, using raw text")
+        # Simple extraction from generated text
+        if prompt in generated_text:
+            return generated_text.split(prompt)[-1].strip()
+        else:
+            return generated_text.strip()
+
+# Cleared once the KV cache has failed with this transformers version
+kv_cache_supported = True
+
+def generate_with_cache_fallback(model, **generate_kwargs):
+    """Run model.generate with the KV cache, falling back to use_cache=False for the
+    rest of the process if Florence-2's remote code rejects the cache format"""
+    global kv_cache_supported
+    if kv_cache_supported:
         try:
-            parsed_answer = processor.post_process_generation(
-                generated_text, 
-                task=prompt, 
-                image_size=(image.width, image.height)
-            )
-            
-            # Extract caption from parsed answer
-            if prompt in parsed_answer:
-                caption = parsed_answer[prompt]
-            else:
-                # Fallback: try to extract from raw text
-                caption = generated_text.split(prompt)[-1].strip()
-        except Exception as parse_error:
-            logger.warning(f"Post-processing failed: {parse_error}, using raw text")
-            # Simple extraction from generated text
-            if prompt in generated_text:
-                caption = generated_text.split(prompt)[-1].strip()
-            else:
-                caption = generated_text.strip()
-        
-        return caption
-        
-    except Exception as e:
-        logger.error(f"Error generating caption for {image_path}: {e}")
-        return f"Error: {str(e)}"
+            return model.generate(**generate_kwargs)
+        except (AttributeError, TypeError, IndexError) as cache_error:
+            logger.warning(f"Generation with KV cache failed ({cache_error}), retrying with use_cache=False")
+            kv_cache_supported = False
+    return model.generate(use_cache=False, **generate_kwargs)
 
-def process_single_image(image_path, model_source, prompt="<MORE_DETAILED_CAPTION>"):
-    """Process a single image and return caption"""
-    
-    # Load model
-    processor, model, device = load_florence_model(model_source)
-    if processor is None:
-        return f"Error: Failed to load model from {model_source}"
+def generate_captions_batch(image_paths, processor, model, device, prompt="<MORE_DETAILED_CAPTION>", batch_size=4,
+                            max_new_tokens=256, num_beams=1):
+    """Generate captions for several image paths or decoded images, running one model.generate per batch"""
+    captions = []
     
-    # Generate caption
-    caption = generate_caption(image_path, processor, model, device, prompt)
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        try:
+            # Load and process images
+            images = [load_image(image) for image in batch_paths]
+            
+            # Prepare inputs for Florence-2
+            inputs = {
+                "input_ids": tokenize_prompt(processor, prompt).repeat(len(images), 1),
+                "pixel_values": processor.image_processor(images, return_tensors="pt")["pixel_values"],
+            }
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            inputs["pixel_values"] = inputs["pixel_values"].to(model.dtype)
+            
+            # Generate captions
+            with torch.inference_mode():
+                generated_ids = generate_with_cache_fallback(
+                    model,
+                    input_ids=inputs["input_ids"],
+                    pixel_values=inputs["pixel_values"],
+                    max_new_tokens=max_new_tokens,
+                    early_stopping=True,
+                    do_sample=False,
+                    num_beams=num_beams,
+                    pad_token_id=processor.tokenizer.pad_token_id
+                )
+            
+            # Decode the generated captions
+            generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=False)
+            for image, generated_text in zip(images, generated_texts):
+                captions.append(parse_caption(processor, generated_text, prompt, (image.width, image.height)))
+            
+        except Exception as e:
+            logger.error(f"Error generating captions for batch of {len(batch_paths)} images: {e}")
+            captions.extend([f"Error: {str(e)}"] * len(batch_paths))
     
-    # Clean up model from memory
-    del model
-    del processor
+    return captions
+
+def generate_caption(image_path, processor, model, device, prompt="<MORE_DETAILED_CAPTION>", max_new_tokens=256, num_beams=1):
+    """Generate caption for a single image using Florence-2"""
+    return generate_captions_batch(
+        [image_path], processor, model, device, prompt,
+        batch_size=1, max_new_tokens=max_new_tokens, num_beams=num_beams
+    )[0]
+
+@functools.lru_cache(maxsize=2)
+def get_florence_model(model_source, compile_model=False):
+    """Load Florence-2 once per model source and keep it resident for later calls"""
+    processor, model, device = load_florence_model(model_source, compile_model)
+    if processor is None:
+        raise RuntimeError(f"Failed to load model from {model_source}")
+    return processor, model, device
+
+def unload_florence():
+    """Drop cached Florence-2 models and release their GPU memory"""
+    get_florence_model.cache_clear()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
+
+def process_single_image(image_path, model_source, prompt="<MORE_DETAILED_CAPTION>", max_new_tokens=256, num_beams=1):
+    """Process a single image and return caption"""
     
-    return caption
+    # Load model, reusing it if already resident
+    try:
+        processor, model, device = get_florence_model(model_source)
+    except RuntimeError as e:
+        return f"Error: {str(e)}"
+    
+    # Generate caption
+    return generate_caption(image_path, processor, model, device, prompt, max_new_tokens, num_beams)
+
+def serve(model_source, prompt="<MORE_DETAILED_CAPTION>", max_new_tokens=256, num_beams=1):
+    """Caption images named by JSON lines on stdin, writing one JSON line per request"""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            caption = process_single_image(
+                request["image_path"],
+                model_source,
+                request.get("prompt", prompt),
+                max_new_tokens=request.get("max_new_tokens", max_new_tokens),
+                num_beams=num_beams
+            )
+            response = {"caption": caption}
+        except Exception as e:
+            response = {"error": str(e)}
+        sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
 
 def main():
     parser = argparse.ArgumentParser(description='Generate captions using Florence-2')
-    parser.add_argument('--image_path', required=True, help='Path to the image file')
+    parser.add_argument('--image_path', help='Path to the image file')
     parser.add_argument('--model_path', default=None, help='Path to local Florence-2 model directory (optional)')
     parser.add_argument('--model_id', default='microsoft/Florence-2-base', help='Hugging Face model ID for Florence-2')
     parser.add_argument('--prompt', default='<MORE_DETAILED_CAPTION>', 
                        help='Florence-2 prompt (default: <MORE_DETAILED_CAPTION>)')
+    parser.add_argument('--max_new_tokens', type=int, default=256, help='Maximum number of caption tokens to generate')
+    parser.add_argument('--num_beams', type=int, default=1, help='Beam search width (1 = greedy decoding)')
+    parser.add_argument('--quality', action='store_true', help='Use 3-beam search for slower but more careful captions')
+    parser.add_argument('--serve', action='store_true',
+                       help='Keep the model loaded and caption image paths read from stdin')
     
     args = parser.parse_args()
+    if not args.serve and not args.image_path:
+        parser.error('--image_path is required unless --serve is set')
+    
+    num_beams = 3 if args.quality else args.num_beams
     
     # Validate inputs
-    image_path = Path(args.image_path)
     model_source = args.model_path if args.model_path else args.model_id
-    
-    if not image_path.exists():
-        print(f"Error: Image file not found: {image_path}")
-        sys.exit(1)
         
     if args.model_path and not Path(args.model_path).exists():
         print(f"Error: Model path not found: {args.model_path}")
         sys.exit(1)
     
+    if args.serve:
+        # Load up front so the first request doesn't pay the cold start
+        try:
+            get_florence_model(model_source)
+        except RuntimeError as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            sys.exit(1)
+        serve(model_source, args.prompt, args.max_new_tokens, num_beams)
+        return
+    
+    image_path = Path(args.image_path)
+    if not image_path.exists():
+        print(f"Error: Image file not found: {image_path}")
+        sys.exit(1)
+    
     # Generate caption
-    caption = process_single_image(str(image_path), model_source, args.prompt)
+    caption = process_single_image(str(image_path), model_source, args.prompt, args.max_new_tokens, num_beams)
     
     # Output result as JSON for easy parsing
     result = {
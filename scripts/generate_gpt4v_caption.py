@@ -1,14 +1,73 @@
 import argparse
 import base64
+import json
+import mmap
 import os
 import sys
 import requests
 from PIL import Image
 import io
 
+# GPT-4V has a maximum dimension requirement
+MAX_DIMENSION = 2048
+
+# Image types the API accepts; MPO is how Pillow reports many camera JPEGs
+API_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'MPO': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+
+# Stands in for the image data URL while the rest of the payload is serialized
+IMAGE_URL_PLACEHOLDER = "__FLUXYOGA_IMAGE_URL__"
+
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    # Encode straight from the page cache instead of reading a copy of the file first
+    with open(image_path, "rb") as image_file, \
+            mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return base64.b64encode(mapped)
+
+def load_image_base64(image_path):
+    """Return the image's MIME type and base64 bytes, only re-encoding images the API
+    cannot take as-is (over the size limit or in an unsupported format)"""
+    # Image.open only parses the header, so size is known without decoding pixels
+    with Image.open(image_path) as img:
+        image_format = img.format or 'JPEG'
+        if image_format in API_MIME_TYPES and max(img.size) <= MAX_DIMENSION:
+            return API_MIME_TYPES[image_format], encode_image(image_path)
+        
+        if max(img.size) > MAX_DIMENSION:
+            ratio = MAX_DIMENSION / max(img.size)
+            new_size = tuple(int(dim * ratio) for dim in img.size)
+            resized = img.resize(new_size, Image.Resampling.LANCZOS)
+        else:
+            resized = img.copy()
+    
+    # Keep supported formats; send anything else (BMP, TIFF, ...) as PNG when it
+    # has transparency and as JPEG otherwise
+    if image_format == 'MPO':
+        save_format = 'JPEG'
+    elif image_format in API_MIME_TYPES:
+        save_format = image_format
+    elif 'A' in resized.getbands() or 'transparency' in resized.info:
+        save_format = 'PNG'
+    else:
+        save_format = 'JPEG'
+    if save_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+        resized = resized.convert('RGB')
+    
+    # Save to bytes
+    img_byte_arr = io.BytesIO()
+    resized.save(img_byte_arr, format=save_format)
+    return API_MIME_TYPES[save_format], base64.b64encode(img_byte_arr.getbuffer())
+
+def build_request_body(payload, mime_type, base64_image):
+    """Serialize the payload, splicing the base64 bytes in without decoding them to str"""
+    body = json.dumps(payload).encode('utf-8')
+    before, after = body.split(IMAGE_URL_PLACEHOLDER.encode('utf-8'), 1)
+    return b"".join([before, f"data:{mime_type};base64,".encode('utf-8'), base64_image, after])
 
 def generate_prompt(style, focus_areas=None):
     base_prompt = {
@@ -25,27 +84,13 @@ def generate_prompt(style, focus_areas=None):
     
     return prompt
 
-def generate_caption(image_path, temperature=0.7, max_tokens=150, style="detailed", focus_areas=None):
+def generate_caption(image_path, temperature=0.7, max_tokens=150, style="detailed", focus_areas=None, session=None):
+    """Caption one image; pass a requests.Session to reuse its pooled connections across calls"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-    # Resize image if needed
-    with Image.open(image_path) as img:
-        # GPT-4V has a maximum dimension requirement
-        max_dim = 2048
-        if max(img.size) > max_dim:
-            ratio = max_dim / max(img.size)
-            new_size = tuple(int(dim * ratio) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Save to bytes
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format=img.format or 'JPEG')
-            img_byte_arr = img_byte_arr.getvalue()
-            base64_image = base64.b64encode(img_byte_arr).decode('utf-8')
-        else:
-            base64_image = encode_image(image_path)
+    mime_type, base64_image = load_image_base64(image_path)
 
     headers = {
         "Content-Type": "application/json",
@@ -67,7 +112,7 @@ def generate_caption(image_path, temperature=0.7, max_tokens=150, style="detaile
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": IMAGE_URL_PLACEHOLDER
                         }
                     }
                 ]
@@ -77,7 +122,9 @@ def generate_caption(image_path, temperature=0.7, max_tokens=150, style="detaile
         "temperature": temperature
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+    body = build_request_body(payload, mime_type, base64_image)
+    http = session or requests
+    response = http.post("https://api.openai.com/v1/chat/completions", headers=headers, data=body)
     if response.status_code != 200:
         raise Exception(f"Error generating caption: {response.text}")
 
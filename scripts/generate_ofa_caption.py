@@ -5,6 +5,14 @@ from PIL import Image
 from transformers import VisionEncoderDecoderModel, GPT2TokenizerFast
 from torchvision import transforms
 
+# Standard ImageNet normalization at the standard ViT input size, built once
+# rather than per image
+IMAGE_TRANSFORM = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
 def load_model():
     """Load the VIT-GPT2 model and tokenizer"""
     try:
@@ -23,22 +31,11 @@ def load_model():
 def preprocess_image(image_path):
     """Preprocess the image for VIT-GPT2 model"""
     try:
-        # Standard ImageNet normalization for ViT
-        mean = [0.485, 0.456, 0.406]
-        std = [0.229, 0.224, 0.225]
-        size = 224  # Standard ViT input size
-        
         # Load and preprocess image
         image = Image.open(image_path).convert('RGB')
         
-        transform = transforms.Compose([
-            transforms.Resize((size, size)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std)
-        ])
-        
         # Apply transform and add batch dimension
-        pixel_values = transform(image).unsqueeze(0)
+        pixel_values = IMAGE_TRANSFORM(image).unsqueeze(0)
         
         # Move to GPU if available
         if torch.cuda.is_available():
@@ -1,112 +1,206 @@
 import argparse
+import functools
+import importlib.util
+import json
 import sys
+import numpy as np
 import torch
 from PIL import Image
-from transformers import VisionEncoderDecoderModel, GPT2TokenizerFast
-from torchvision import transforms
+from transformers import BitsAndBytesConfig, VisionEncoderDecoderModel, GPT2TokenizerFast
 
-def load_model():
+HAS_BITSANDBYTES = importlib.util.find_spec("bitsandbytes") is not None
+
+# Standard ImageNet normalization for ViT
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+IMAGE_SIZE = 224  # Standard ViT input size
+
+# Strips punctuation before captions are split into tags
+TAG_PUNCTUATION = str.maketrans("", "", ".,")
+
+# Common words dropped from tag-style captions
+STOP_WORDS = frozenset({"a", "an", "the", "is", "are", "with", "and", "or", "of", "in", "on", "at", "this", "that"})
+
+# ViT input is always IMAGE_SIZE square, so let cuDNN pick the fastest kernels
+torch.backends.cudnn.benchmark = True
+
+def load_model(compile_model=False, load_in_8bit=False):
     """Load the VIT-GPT2 model and tokenizer"""
     try:
-        model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
         tokenizer = GPT2TokenizerFast.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
         
+        if load_in_8bit and not (torch.cuda.is_available() and HAS_BITSANDBYTES):
+            print("Warning: int8 loading needs CUDA and bitsandbytes, using full precision", file=sys.stderr)
+            load_in_8bit = False
+        
+        if load_in_8bit:
+            # Quantize only the GPT-2 decoder; the ViT encoder stays in fp16
+            model = VisionEncoderDecoderModel.from_pretrained(
+                "nlpconnect/vit-gpt2-image-captioning",
+                torch_dtype=torch.float16,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=["encoder"]),
+                device_map="auto"
+            )
+            model.eval()
+            model.requires_grad_(False)
+            return tokenizer, model
+        
+        model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
+        model.eval()
+        model.requires_grad_(False)
+        
         # Move to GPU if available
         if torch.cuda.is_available():
             model = model.cuda()
+            
+            # generate() calls model.forward once per decoding step; the sequence
+            # grows every step, so compile for dynamic shapes as the BLIP and
+            # Florence-2 decoders are, rather than recording a CUDA graph per length
+            if compile_model:
+                model.forward = torch.compile(model.forward, dynamic=True)
         
         return tokenizer, model
     except Exception as e:
-        print(f"Error loading model: {e}", file=sys.stderr)
-        sys.exit(1)
+        # Raise rather than exit so importers such as batch_caption can report it;
+        # the CLI main turns it into an error message and exit status
+        raise RuntimeError(f"Failed to load VIT-GPT2 model: {e}") from e
 
-def preprocess_image(image_path):
-    """Preprocess the image for VIT-GPT2 model"""
+def load_image(image):
+    """Open an image path as RGB, passing through images that were already decoded"""
+    if isinstance(image, Image.Image):
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    return Image.open(image).convert('RGB')
+
+@functools.lru_cache(maxsize=None)
+def get_normalization(device):
+    """Mean and std shaped for broadcasting over a (B, 3, H, W) batch, cached per device"""
+    mean = torch.tensor(IMAGE_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=device).view(1, 3, 1, 1)
+    return mean, std
+
+def preprocess_images(image_paths):
+    """Preprocess several image paths or decoded images into one batched tensor for VIT-GPT2 model"""
     try:
-        # Standard ImageNet normalization for ViT
-        mean = [0.485, 0.456, 0.406]
-        std = [0.229, 0.224, 0.225]
-        size = 224  # Standard ViT input size
-        
-        # Load and preprocess image
-        image = Image.open(image_path).convert('RGB')
-        
-        transform = transforms.Compose([
-            transforms.Resize((size, size)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std)
-        ])
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        mean, std = get_normalization(device)
         
-        # Apply transform and add batch dimension
-        pixel_values = transform(image).unsqueeze(0)
+        # Load and resize images, then stack them as one uint8 (B, H, W, 3) array
+        images = [
+            load_image(image).resize((IMAGE_SIZE, IMAGE_SIZE), Image.Resampling.BILINEAR)
+            for image in image_paths
+        ]
+        pixels = torch.from_numpy(np.stack([np.asarray(image) for image in images]))
         
-        # Move to GPU if available
-        if torch.cuda.is_available():
-            pixel_values = pixel_values.cuda()
+        # Copy the compact uint8 batch to the device and normalize it there in place
+        pixel_values = pixels.to(device, non_blocking=True).permute(0, 3, 1, 2).float()
+        pixel_values.div_(255).sub_(mean).div_(std)
         
         return pixel_values
     
     except Exception as e:
         print(f"Error preprocessing image: {e}", file=sys.stderr)
-        sys.exit(1)
+        raise
+
+def preprocess_image(image_path):
+    """Preprocess the image for VIT-GPT2 model"""
+    return preprocess_images([image_path])
+
+def postprocess_caption(caption, style):
+    """Post-process a decoded caption based on style"""
+    if style == "tags":
+        # Convert to comma-separated tags
+        words = caption.lower().translate(TAG_PUNCTUATION).split()
+        # Remove short words and common stop words (length check first, it's cheaper)
+        tags = [word for word in words if len(word) > 2 and word not in STOP_WORDS]
+        caption = ", ".join(tags[:8])  # Limit to 8 tags
+    elif style == "simple":
+        # Keep original (VIT-GPT2 already generates simple captions)
+        pass
+    elif style == "artistic":
+        # Add artistic touch
+        if not caption.endswith("."):
+            caption += "."
+        caption = f"An enchanting view of {caption.lower()}"
+    
+    return caption.strip()
+
+def generate_captions_batch(image_paths, tokenizer, model, batch_size=8, max_length=50, style="detailed"):
+    """Generate captions for several image paths or decoded images, running one model.generate per batch"""
+    captions = []
+    
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        try:
+            # Preprocess the images
+            pixel_values = preprocess_images(batch_paths).to(model.dtype)
+            
+            # Generate captions
+            with torch.inference_mode():
+                generated_ids = model.generate(
+                    pixel_values,
+                    max_length=max_length,
+                    num_beams=4,
+                    early_stopping=True,
+                    no_repeat_ngram_size=2,
+                    length_penalty=1.0
+                )
+            
+            # Decode the generated captions
+            for caption in tokenizer.batch_decode(generated_ids, skip_special_tokens=True):
+                captions.append(postprocess_caption(caption, style))
+        
+        except Exception as e:
+            print(f"Error generating caption: {e}", file=sys.stderr)
+            captions.extend([f"Error: {str(e)}"] * len(batch_paths))
+    
+    return captions
 
 def generate_caption(image_path, tokenizer, model, max_length=50, style="detailed"):
     """Generate a caption for the image using VIT-GPT2 model"""
-    try:
-        # Preprocess the image
-        pixel_values = preprocess_image(image_path)
-        
-        # Generate caption
-        with torch.no_grad():
-            generated_ids = model.generate(
-                pixel_values,
-                max_length=max_length,
-                num_beams=4,
-                early_stopping=True,
-                no_repeat_ngram_size=2,
-                length_penalty=1.0
+    return generate_captions_batch([image_path], tokenizer, model, batch_size=1, max_length=max_length, style=style)[0]
+
+def serve(tokenizer, model, max_length=50, style="detailed"):
+    """Caption images named by JSON lines on stdin, writing one JSON line per request"""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            caption = generate_caption(
+                request["image_path"],
+                tokenizer,
+                model,
+                max_length=request.get("max_length", max_length),
+                style=request.get("style", style)
             )
-        
-        # Decode the generated caption
-        caption = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
-        
-        # Post-process based on style
-        if style == "tags":
-            # Convert to comma-separated tags
-            words = caption.lower().replace(".", "").replace(",", "").split()
-            # Remove common stop words
-            stop_words = {"a", "an", "the", "is", "are", "with", "and", "or", "of", "in", "on", "at", "this", "that"}
-            tags = [word for word in words if word not in stop_words and len(word) > 2]
-            caption = ", ".join(tags[:8])  # Limit to 8 tags
-        elif style == "simple":
-            # Keep original (VIT-GPT2 already generates simple captions)
-            pass
-        elif style == "artistic":
-            # Add artistic touch
-            if not caption.endswith("."):
-                caption += "."
-            caption = f"An enchanting view of {caption.lower()}"
-        
-        return caption.strip()
-    
-    except Exception as e:
-        print(f"Error generating caption: {e}", file=sys.stderr)
-        return f"Error: {str(e)}"
+            response = {"caption": caption}
+        except Exception as e:
+            response = {"error": str(e)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
 
 def main():
     parser = argparse.ArgumentParser(description="Generate image captions using VIT-GPT2 model")
-    parser.add_argument("--image_path", required=True, help="Path to the image file")
+    parser.add_argument("--image_path", help="Path to the image file")
     parser.add_argument("--style", default="detailed", 
                        choices=["detailed", "simple", "tags", "artistic"])
     parser.add_argument("--max_length", type=int, default=50,
                        help="Maximum length of generated caption")
+    parser.add_argument("--serve", action="store_true",
+                       help="Keep the model loaded and caption image paths read from stdin")
     
     args = parser.parse_args()
+    if not args.serve and not args.image_path:
+        parser.error("--image_path is required unless --serve is set")
     
     try:
         # Load model and tokenizer
         tokenizer, model = load_model()
         
+        if args.serve:
+            serve(tokenizer, model, max_length=args.max_length, style=args.style)
+            return
+        
         # Generate caption
         caption = generate_caption(
             args.image_path,
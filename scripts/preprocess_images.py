@@ -1,62 +1,273 @@
 import argparse
 import os
-from PIL import Image, ImageEnhance
-import torchvision.transforms as transforms
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+import PIL
+from PIL import Image, ImageFilter, ImageStat
 import numpy as np
 from tqdm import tqdm
 
-def process_image(image_path, config):
-    """Process a single image according to the configuration"""
+try:
     try:
-        img = Image.open(image_path)
+        from cykooz_resizer import CropBox, FilterType, ResizeAlg, ResizeOptions, Resizer
+    except ImportError:
+        # cykooz.resizer < 4.0 shipped as a namespace package
+        from cykooz.resizer import CropBox, FilterType, ResizeAlg, ResizeOptions, Resizer
+    # CPU extensions (AVX2/SSE4.1/NEON) are picked automatically at runtime
+    RESIZER = Resizer()
+    RESIZE_OPTIONS = ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.lanczos3))
+    HAS_CYKOOZ = True
+except ImportError:
+    HAS_CYKOOZ = False
+
+try:
+    from turbojpeg import (TJCS_CMYK, TJCS_YCCK, TJFLAG_FASTDCT, TJPF_GRAY, TJPF_RGB,
+                           TJSAMP_GRAY, TurboJPEG)
+    # Raises if the libjpeg-turbo shared library itself cannot be found
+    TURBO_JPEG = TurboJPEG()
+    HAS_TURBOJPEG = True
+except (ImportError, OSError, RuntimeError):
+    HAS_TURBOJPEG = False
+
+try:
+    import imagecodecs
+    HAS_IMAGECODECS = True
+except ImportError:
+    HAS_IMAGECODECS = False
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.webp'})
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Pixel layouts with SIMD paths in fast_image_resize and Pillow-SIMD
+FAST_MODES = ('RGB', 'RGBA', 'L')
+# Single-band modes wider than 8 bits; I;16 also has B/L/N byte-order variants
+HIGH_DEPTH_MODES = ('I', 'F')
+
+# ImageNet channel statistics on the 0-255 pixel scale
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32) * 255
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32) * 255
+# (x - MEAN) / STD mapped back onto 0-255 is a per-channel multiply
+NORMALIZE_SCALE = 255 / STD
+
+CONTRAST_FACTOR = 1.5
+SHARPNESS_FACTOR = 1.5
+# ImageEnhance.Sharpness(f) blends toward ImageFilter.SMOOTH (center 5,
+# neighbours 1, /13): f*x - (f-1)*smooth. Folded into one 3x3 convolution
+# (scaled by 26 for f=1.5) it is a single pass, and the numba kernel below
+# computes exactly the same stencil, so both paths give the same pixels
+SHARPEN_FILTER = ImageFilter.Kernel((3, 3), [-1, -1, -1, -1, 34, -1, -1, -1, -1], scale=26)
+
+# Pillow-SIMD releases carry a ".postN" version suffix
+PILLOW_SIMD = ".post" in PIL.__version__
+
+def resize_image(img, size, box=None):
+    """Lanczos-resize img (or the (left, top, right, bottom) box of it) to size,
+    using cykooz.resizer's SIMD kernels when installed"""
+    if HAS_CYKOOZ and img.mode in FAST_MODES:
+        options = RESIZE_OPTIONS
+        if box is not None:
+            options = RESIZE_OPTIONS.copy()
+            options.crop_box = CropBox(box[0], box[1], box[2] - box[0], box[3] - box[1])
+        resized = Image.new(img.mode, size)
+        RESIZER.resize_pil(img, resized, options)
+        # Carry metadata such as icc_profile over, as Image.resize does
+        resized.info = img.info.copy()
+        return resized
+    return img.resize(size, Image.Resampling.LANCZOS, box=box)
+
+@lru_cache(maxsize=1024)
+def contrast_lut(mean, mode):
+    """Image.point table for ImageEnhance.Contrast's blend about a gray mean,
+    leaving any alpha band untouched as ImageEnhance does"""
+    lut = (np.arange(256, dtype=np.float32) - mean) * CONTRAST_FACTOR + mean
+    lut = np.clip(lut, 0, 255).astype(np.uint8).tolist() * len(mode.replace('A', ''))
+    if 'A' in mode:
+        lut += list(range(256))
+    return lut
+
+if HAS_NUMBA:
+    # Images are already spread across a worker pool, so the kernel itself
+    # runs serially; numba's default threading layer is not safe to enter
+    # from several threads at once. nogil lets the pool's threads run it
+    # on separate cores
+    @numba.njit(fastmath=True, cache=True, nogil=True)
+    def _contrast_sharpen(src, dst, lut, bands, factor):
+        """Contrast every pixel through lut, then sharpen it against its 3x3
+        ImageFilter.SMOOTH neighbourhood as ImageEnhance.Sharpness does, reading
+        the source once and keeping the contrasted values in registers"""
+        height, width, channels = src.shape
+        for y in range(height):
+            for x in range(width):
+                for c in range(channels):
+                    if c >= bands:
+                        dst[y, x, c] = src[y, x, c]
+                        continue
+                    center = lut[src[y, x, c]]
+                    if y == 0 or x == 0 or y == height - 1 or x == width - 1:
+                        # ImageEnhance leaves the border unsharpened
+                        dst[y, x, c] = center
+                        continue
+                    smooth = 4.0 * center
+                    for dy in range(-1, 2):
+                        for dx in range(-1, 2):
+                            smooth += lut[src[y + dy, x + dx, c]]
+                    smooth /= 13.0
+                    value = smooth + factor * (center - smooth)
+                    dst[y, x, c] = min(max(value, 0.0), 255.0) + 0.5
+
+def contrast_sharpen(img, mean):
+    """Apply contrast about mean and sharpening in one fused numba pass"""
+    src = np.asarray(img)
+    if src.ndim == 2:
+        src = src[:, :, None]
+    dst = np.empty_like(src)
+    lut = np.array(contrast_lut(mean, 'L'), dtype=np.float32)
+    _contrast_sharpen(src, dst, lut, len(img.mode.replace('A', '')), SHARPNESS_FACTOR)
+    return Image.fromarray(dst[:, :, 0] if img.mode == 'L' else dst)
+
+def load_image(image_path, draft_size=None):
+    """Open an image, decoding JPEGs with libjpeg-turbo when available.
+    With draft_size, JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 DCT
+    scale that still covers it; other formats ignore it."""
+    if HAS_TURBOJPEG and image_path.lower().endswith(JPEG_EXTENSIONS):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        width, height, subsample, colorspace = TURBO_JPEG.decode_header(data)
+        # libjpeg-turbo cannot convert CMYK/YCCK to RGB; Pillow handles those below
+        if colorspace not in (TJCS_CMYK, TJCS_YCCK):
+            scaling_factor = None
+            if draft_size:
+                scale = min(width // draft_size[0], height // draft_size[1])
+                scaling_factor = next(((1, d) for d in (8, 4, 2) if d <= scale), None)
+            # Grayscale JPEGs stay single-band (mode L), as Pillow opens them
+            if subsample == TJSAMP_GRAY:
+                pixels = TURBO_JPEG.decode(data, pixel_format=TJPF_GRAY,
+                                           scaling_factor=scaling_factor, flags=TJFLAG_FASTDCT)
+                return Image.fromarray(pixels[:, :, 0])
+            return Image.fromarray(TURBO_JPEG.decode(data, pixel_format=TJPF_RGB,
+                                                     scaling_factor=scaling_factor, flags=TJFLAG_FASTDCT))
+    img = Image.open(image_path)
+    if draft_size:
+        img.draft('RGB', draft_size)
+    return img
+
+def encode_image(img, output_path):
+    """Encode the pixel buffer straight to JPEG (libjpeg-turbo) or PNG (imagecodecs),
+    skipping Image.save's plugin dispatch. Returns None when neither applies."""
+    path = output_path.lower()
+    if HAS_TURBOJPEG and path.endswith(JPEG_EXTENSIONS):
+        if img.mode == 'L':
+            return TURBO_JPEG.encode(np.asarray(img)[:, :, None], quality=95, pixel_format=TJPF_GRAY,
+                                     jpeg_subsample=TJSAMP_GRAY, flags=TJFLAG_FASTDCT)
+        if img.mode == 'RGB':
+            return TURBO_JPEG.encode(np.asarray(img), quality=95, pixel_format=TJPF_RGB,
+                                     flags=TJFLAG_FASTDCT)
+    elif HAS_IMAGECODECS and path.endswith('.png'):
+        return imagecodecs.png_encode(np.asarray(img), level=6)
+    return None
+
+def save_image(img, output_path, optimize=False):
+    """Save an image, bypassing Pillow's encoders when a direct one is available.
+    optimize trades a second encoder pass for slightly smaller files."""
+    # Pillow is still needed to optimize the encoding or carry an ICC profile
+    if not optimize and img.mode in FAST_MODES and 'icc_profile' not in img.info:
+        data = encode_image(img, output_path)
+        if data is not None:
+            with open(output_path, 'wb') as f:
+                f.write(data)
+            return
+    if optimize:
+        img.save(output_path, quality=95, optimize=True)
+    else:
+        # compress_level only applies to PNG; JPEG uses quality
+        img.save(output_path, quality=95, compress_level=6)
+
+def _resize_keep_ratio(img, target_size):
+    """Fit img inside target_size, maintaining aspect ratio"""
+    ratio = min(target_size[0] / img.size[0], target_size[1] / img.size[1])
+    new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
+    return resize_image(img, new_size)
+
+def _resize_fill(img, target_size):
+    """Stretch img to exactly target_size"""
+    return resize_image(img, target_size)
+
+def _resize_crop(img, target_size):
+    """Cover target_size and center crop the overflow"""
+    # Map the centered target window back to source coordinates
+    # and resample it once instead of resizing then cropping
+    ratio = max(target_size[0] / img.size[0], target_size[1] / img.size[1])
+    src_w = target_size[0] / ratio
+    src_h = target_size[1] / ratio
+    left = (img.size[0] - src_w) / 2
+    top = (img.size[1] - src_h) / 2
+    return resize_image(img, target_size, (left, top, left + src_w, top + src_h))
+
+RESIZE_MODES = {
+    'keep_ratio': _resize_keep_ratio,
+    'fill': _resize_fill,
+    'crop': _resize_crop,
+}
+
+def process_image(image_path, resize_fn, config):
+    """Process a single image according to the configuration.
+    resize_fn is the run's resize mode bound to its target size, or None."""
+    try:
+        img = load_image(image_path, config['draft_size'])
         
-        # Convert RGBA to RGB if necessary
-        if img.mode == 'RGBA':
+        # Normalize to a layout the fast kernels handle, keeping alpha only
+        # where the output format (which follows the input's) can store it.
+        # High bit depth images (I;16, I, F) would be clipped to 8 bits by
+        # convert(), so they stay as-is and use Pillow's resize and save
+        keep_alpha = not image_path.lower().endswith(JPEG_EXTENSIONS)
+        if img.mode in HIGH_DEPTH_MODES or img.mode.startswith('I;16'):
+            pass
+        elif img.mode not in FAST_MODES:
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha and keep_alpha else 'RGB')
+        elif img.mode == 'RGBA' and not keep_alpha:
             img = img.convert('RGB')
             
         # Resize image
-        if config['resize_enabled']:
-            target_size = (config['target_width'], config['target_height'])
-            
-            if config['resize_mode'] == 'keep_ratio':
-                # Calculate new size maintaining aspect ratio
-                ratio = min(target_size[0] / img.size[0], target_size[1] / img.size[1])
-                new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            elif config['resize_mode'] == 'fill':
-                img = img.resize(target_size, Image.Resampling.LANCZOS)
-            elif config['resize_mode'] == 'crop':
-                # Resize and crop to target size
-                ratio = max(target_size[0] / img.size[0], target_size[1] / img.size[1])
-                new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                
-                # Center crop
-                left = (img.size[0] - target_size[0]) // 2
-                top = (img.size[1] - target_size[1]) // 2
-                img = img.crop((left, top, left + target_size[0], top + target_size[1]))
+        if resize_fn is not None:
+            img = resize_fn(img)
+        
+        # The fused kernel indexes an 8-bit table, so it only takes 8-bit
+        # layouts; other modes go through point()/filter(), which reject them
+        fused = config['fuse_contrast_sharpen'] and img.mode in FAST_MODES
         
         # Apply color corrections
         if config['auto_contrast']:
-            img = ImageEnhance.Contrast(img).enhance(1.5)
+            # Same pivot as ImageEnhance.Contrast, applied as a single point() pass
+            mean = int(ImageStat.Stat(img.convert('L')).mean[0] + 0.5)
+            if fused:
+                img = contrast_sharpen(img, mean)
+            else:
+                img = img.point(contrast_lut(mean, img.mode))
         
         if config['normalize']:
-            # Convert to tensor for normalization
-            transform = transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406],
-                    std=[0.229, 0.224, 0.225]
-                )
-            ])
-            img_tensor = transform(img)
-            # Convert back to PIL Image
-            img = transforms.ToPILImage()(img_tensor)
+            # ImageNet mean/std normalization on the pixels, clamped back into
+            # the displayable range with in-place ufuncs on a single buffer
+            arr = np.asarray(img.convert('RGB'), dtype=np.float32)
+            np.subtract(arr, MEAN, out=arr)
+            np.multiply(arr, NORMALIZE_SCALE, out=arr)
+            np.clip(arr, 0, 255, out=arr)
+            img = Image.fromarray(arr.astype(np.uint8))
         
-        if config['sharpen']:
-            # Apply sharpening
-            enhancer = ImageEnhance.Sharpness(img)
-            img = enhancer.enhance(1.5)
+        if config['sharpen'] and not fused:
+            # Apply sharpening to the color bands only
+            if img.mode == 'RGBA':
+                alpha = img.getchannel('A')
+                img = img.convert('RGB').filter(SHARPEN_FILTER)
+                img.putalpha(alpha)
+            else:
+                img = img.filter(SHARPEN_FILTER)
         
         return img
         
@@ -64,6 +275,30 @@ def process_image(image_path, config):
         print(f"Error processing {image_path}: {str(e)}")
         return None
 
+# Per-process settings installed by _init_worker
+_worker_config = None
+_worker_resize = None
+
+def _init_worker(config, resize_fn):
+    """Pool initializer: stash the shared configuration in each worker process"""
+    global _worker_config, _worker_resize
+    _worker_config = config
+    _worker_resize = resize_fn
+
+def is_image_name(name):
+    """Check the extension without lowercasing the whole filename"""
+    dot = name.rfind('.')
+    return dot >= 0 and name[dot:].lower() in IMAGE_EXTENSIONS
+
+def _worker(input_path):
+    """Process and save one image into the output directory"""
+    config = _worker_config
+    output_path = os.path.join(config['output_dir'], os.path.basename(input_path))
+    
+    processed_img = process_image(input_path, _worker_resize, config)
+    if processed_img:
+        save_image(processed_img, output_path, config['optimize'])
+
 def main():
     parser = argparse.ArgumentParser(description="Preprocess images for machine learning")
     parser.add_argument("--input_dir", required=True, help="Input directory containing images")
@@ -74,34 +309,54 @@ def main():
     parser.add_argument("--auto_contrast", action="store_true", help="Apply automatic contrast")
     parser.add_argument("--normalize", action="store_true", help="Normalize pixel values")
     parser.add_argument("--sharpen", action="store_true", help="Apply sharpening")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Optimize output encoding for size (slower saves)")
+    parser.add_argument("--use_processes", action="store_true",
+                        help="Process images in worker processes instead of threads")
     
     args = parser.parse_args()
     
+    backend = "Pillow-SIMD" if PILLOW_SIMD else "Pillow"
+    resizer = "cykooz.resizer" if HAS_CYKOOZ else backend
+    jpeg_codec = "libjpeg-turbo" if HAS_TURBOJPEG else backend
+    png_codec = "imagecodecs" if HAS_IMAGECODECS else backend
+    print(f"Using {backend} {PIL.__version__} for image processing, {resizer} for resizing, "
+          f"{jpeg_codec} for JPEG, {png_codec} for PNG")
+    
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
     
+    # The resize mode is fixed for the run, so pick it once here
+    resize_fn = partial(RESIZE_MODES[args.resize_mode],
+                        target_size=(args.target_width, args.target_height))
+    
     config = {
-        'resize_enabled': True,
-        'resize_mode': args.resize_mode,
-        'target_width': args.target_width,
-        'target_height': args.target_height,
+        'output_dir': args.output_dir,
+        # Decoding JPEGs at twice the target size keeps headroom for Lanczos
+        'draft_size': (args.target_width * 2, args.target_height * 2),
         'auto_contrast': args.auto_contrast,
         'normalize': args.normalize,
-        'sharpen': args.sharpen
+        'sharpen': args.sharpen,
+        # With numba, contrast and sharpening share one pass when nothing
+        # runs between them
+        'fuse_contrast_sharpen': HAS_NUMBA and args.auto_contrast and args.sharpen and not args.normalize,
+        'optimize': args.optimize
     }
     
-    # Get list of image files
-    image_files = [f for f in os.listdir(args.input_dir) 
-                  if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+    # Get list of image files; scandir entries carry their file type already
+    with os.scandir(args.input_dir) as entries:
+        image_files = [entry.path for entry in entries
+                       if is_image_name(entry.name) and entry.is_file()]
     
-    # Process images with progress bar
-    for filename in tqdm(image_files, desc="Processing images"):
-        input_path = os.path.join(args.input_dir, filename)
-        output_path = os.path.join(args.output_dir, filename)
-        
-        processed_img = process_image(input_path, config)
-        if processed_img:
-            processed_img.save(output_path, quality=95, optimize=True)
+    # Images are independent, so spread them across all cores. Decode, resize,
+    # filters, NumPy math and encode all release the GIL, so threads scale
+    # without forking workers or pickling; processes remain available for
+    # builds where that does not hold
+    executor_class = ProcessPoolExecutor if args.use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=os.cpu_count(), initializer=_init_worker,
+                        initargs=(config, resize_fn)) as executor:
+        list(tqdm(executor.map(_worker, image_files, chunksize=8),
+                  total=len(image_files), desc="Processing images"))
 
 if __name__ == "__main__":
     main()
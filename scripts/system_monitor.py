@@ -1,9 +1,14 @@
 import argparse
 import json
+from functools import lru_cache
 import psutil
 import time
 import sys
 
+# Prime psutil's CPU counters so monitor_system's cpu_percent(interval=None)
+# calls report usage since the previous call instead of blocking each sample
+psutil.cpu_percent(interval=None)
+
 try:
     import torch
     HAS_TORCH = True
@@ -17,6 +22,18 @@ try:
 except ImportError:
     HAS_NVIDIA = False
 
+@lru_cache(maxsize=16)
+def get_device_properties(index):
+    """Get the name and total memory (MB) of a CUDA device, which never change"""
+    name = torch.cuda.get_device_name(index)
+    total_memory = torch.cuda.get_device_properties(index).total_memory // (1024**2)
+    return name, total_memory
+
+@lru_cache(maxsize=16)
+def get_nvml_handle(index):
+    """Get the NVML handle for a device index"""
+    return pynvml.nvmlDeviceGetHandleByIndex(index)
+
 def get_gpu_info():
     """Get GPU information"""
     gpu_info = {
@@ -30,10 +47,11 @@ def get_gpu_info():
         gpu_info['count'] = torch.cuda.device_count()
         
         for i in range(gpu_info['count']):
+            name, memory_total = get_device_properties(i)
             device_info = {
                 'id': i,
-                'name': torch.cuda.get_device_name(i),
-                'memory_total': torch.cuda.get_device_properties(i).total_memory // (1024**2),  # MB
+                'name': name,
+                'memory_total': memory_total,  # MB
                 'memory_allocated': torch.cuda.memory_allocated(i) // (1024**2),  # MB
                 'memory_reserved': torch.cuda.memory_reserved(i) // (1024**2),  # MB
             }
@@ -41,7 +59,7 @@ def get_gpu_info():
             # Add NVIDIA specific info if available
             if HAS_NVIDIA:
                 try:
-                    handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+                    handle = get_nvml_handle(i)
                     
                     # GPU utilization
                     util = pynvml.nvmlDeviceGetUtilizationRates(handle)
@@ -65,13 +83,33 @@ def get_gpu_info():
     
     return gpu_info
 
-def get_system_info():
-    """Get system information"""
+# Disk totals and CPU frequency change slowly, and cpu_freq() can take ~10ms
+# through WMI on Windows, so they are re-read at most every few seconds
+SLOW_SAMPLE_SECONDS = 5.0
+_slow_samples = {}
+
+def sample_slowly(name, read):
+    """Return read()'s last result, refreshing it once SLOW_SAMPLE_SECONDS have passed"""
+    now = time.monotonic()
+    cached = _slow_samples.get(name)
+    if cached is None or now - cached[0] > SLOW_SAMPLE_SECONDS:
+        cached = (now, read())
+        _slow_samples[name] = cached
+    return cached[1]
+
+def read_cpu_frequency():
+    """Read the CPU frequency, if psutil can on this platform"""
+    frequency = psutil.cpu_freq()
+    return frequency._asdict() if frequency else None
+
+def get_system_info(cpu_interval=0.1):
+    """Get system information. cpu_interval is how long to sample CPU usage for;
+    None reports usage since the previous call without blocking."""
     # CPU info
     cpu_info = {
         'count': psutil.cpu_count(),
-        'usage_percent': psutil.cpu_percent(interval=1),
-        'frequency': psutil.cpu_freq()._asdict() if psutil.cpu_freq() else None,
+        'usage_percent': psutil.cpu_percent(interval=cpu_interval),
+        'frequency': sample_slowly('cpu_freq', read_cpu_frequency),
     }
     
     # Memory info
@@ -84,7 +122,7 @@ def get_system_info():
     }
     
     # Disk info
-    disk = psutil.disk_usage('/')
+    disk = sample_slowly('disk', lambda: psutil.disk_usage('/'))
     disk_info = {
         'total': disk.total // (1024**3),  # GB
         'used': disk.used // (1024**3),  # GB
@@ -102,9 +140,10 @@ def monitor_system(duration=10, interval=1):
     """Monitor system for a duration"""
     monitoring_data = []
     
+    # CPU usage is measured over the sleep between samples
     for _ in range(duration):
         timestamp = time.time()
-        system_info = get_system_info()
+        system_info = get_system_info(cpu_interval=None)
         gpu_info = get_gpu_info()
         
         data_point = {
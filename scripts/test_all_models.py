@@ -4,62 +4,88 @@ Test script to verify all caption generation models work
 Tests on a single image from the sample folder
 """
 
+import json
 import os
+import queue
 import sys
 import subprocess
+import threading
 from pathlib import Path
 
 # Test configuration
 TEST_IMAGE = r"C:\Users\rosha\Work\apps\catnip\fluxyoga\sample\reanita\simin_01.png"
 SCRIPT_DIR = Path(__file__).parent
 PYTHON_EXE = r"C:/Users/rosha/Work/apps/catnip/fluxyoga/.venv/Scripts/python.exe"
+WORKER_SCRIPT = SCRIPT_DIR / 'caption_worker.py'
+TIMEOUT = 120  # 2 minutes per model, including its load
 
-# Models to test
+# Models to test, with the request sent to caption_worker.py for each
 MODELS = {
     'blip': {
-        'script': 'generate_blip_caption.py',
-        'args': ['--image_path', TEST_IMAGE, '--model_type', 'base', '--style', 'detailed']
+        'args': {'image_path': TEST_IMAGE, 'style': 'detailed'}
     },
     'blip2': {
-        'script': 'generate_blip_caption.py', 
-        'args': ['--image_path', TEST_IMAGE, '--model_type', 'large', '--style', 'detailed']
+        'args': {'image_path': TEST_IMAGE, 'style': 'detailed'}
     },
     'vit-gpt2': {
-        'script': 'generate_ofa_caption.py',
-        'args': ['--image_path', TEST_IMAGE, '--style', 'detailed']
+        'args': {'image_path': TEST_IMAGE, 'style': 'detailed'}
     }
 }
 
-def test_model(model_name, config):
+def start_worker():
+    """Start one caption worker so torch/transformers are imported once for all models"""
+    process = subprocess.Popen(
+        [PYTHON_EXE, str(WORKER_SCRIPT)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        bufsize=1,
+        cwd=str(SCRIPT_DIR.parent)
+    )
+    
+    # Pipes cannot be select()ed on Windows, so a thread queues the responses
+    # and the reads below wait on the queue with a timeout
+    responses = queue.Queue()
+    
+    def read_responses():
+        for line in process.stdout:
+            responses.put(line)
+        responses.put(None)
+    
+    threading.Thread(target=read_responses, daemon=True).start()
+    return process, responses
+
+def test_model(worker, model_name, config):
     """Test a single caption generation model"""
     print(f"\n🧪 Testing {model_name}...")
     print("-" * 50)
     
-    script_path = SCRIPT_DIR / config['script']
-    cmd = [PYTHON_EXE, str(script_path)] + config['args']
+    process, responses = worker
+    request = {'model': model_name, **config['args']}
     
     try:
-        # Run the caption generation script
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
-            timeout=120,  # 2 minute timeout
-            cwd=str(SCRIPT_DIR.parent)
-        )
+        # Ask the worker for a caption
+        process.stdin.write(json.dumps(request) + "\n")
+        process.stdin.flush()
+        
+        line = responses.get(timeout=TIMEOUT)
+        if line is None:
+            raise RuntimeError(f"Caption worker exited with status {process.wait()}")
+        response = json.loads(line)
         
-        if result.returncode == 0:
-            caption = result.stdout.strip()
+        if 'caption' in response:
+            caption = response['caption'].strip()
             print(f"✅ {model_name} SUCCESS")
             print(f"📝 Caption: {caption}")
             return True, caption
         else:
-            error = result.stderr.strip() or "Unknown error"
+            error = response.get('error') or "Unknown error"
             print(f"❌ {model_name} FAILED")
             print(f"🚨 Error: {error}")
             return False, error
             
-    except subprocess.TimeoutExpired:
+    except queue.Empty:
         print(f"⏰ {model_name} TIMEOUT (>2 minutes)")
         return False, "Timeout"
     except Exception as e:
@@ -81,12 +107,25 @@ def main():
     results = {}
     success_count = 0
     
-    # Test each model
-    for model_name, config in MODELS.items():
-        success, output = test_model(model_name, config)
-        results[model_name] = {'success': success, 'output': output}
-        if success:
-            success_count += 1
+    # Test each model in one shared worker process
+    worker = start_worker()
+    try:
+        for model_name, config in MODELS.items():
+            success, output = test_model(worker, model_name, config)
+            results[model_name] = {'success': success, 'output': output}
+            if success:
+                success_count += 1
+            elif worker[0].poll() is not None or output == "Timeout":
+                # A late or missing reply would be read as the next model's,
+                # so continue in a fresh worker
+                worker[0].kill()
+                worker = start_worker()
+    finally:
+        worker[0].stdin.close()
+        try:
+            worker[0].wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            worker[0].kill()
     
     # Summary
     print("\n📊 SUMMARY")